@@ -8,12 +8,13 @@ Description  : JSONPath
 __version__ = "1.0.6"
 __author__ = "zhangxianbing"
 
+import ast
+import builtins
 import json
 import logging
 import os
 import re
-import sys
-from collections import defaultdict
+from functools import lru_cache
 from typing import Union
 
 
@@ -38,10 +39,64 @@ def create_logger(name: str = None, level: Union[int, str] = logging.INFO):
 logger = create_logger("jsonpath", os.getenv("PYLOGLEVEL", "INFO"))
 
 
+def _env_cache_size(default: int = 1024):
+    """Read JSONPATH_CACHE: a size of 0 or more, or "none" for no bound."""
+    value = os.getenv("JSONPATH_CACHE")
+    if value is None:
+        return default
+    if value.strip().lower() == "none":
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size < 0:
+        logger.warning("invalid JSONPATH_CACHE=%r, using %d", value, default)
+        return default
+    return size
+
+
+# size of the caches of compiled expressions and filters, bounded to keep
+# long-running processes flat
+_cache_size = _env_cache_size()
+
+
 class ExprSyntaxError(Exception):
     pass
 
 
+# step opcodes, resolved once per segment by `JSONPath._compile_step`
+OP_KEY = 0
+OP_INDEX = 1
+OP_WILDCARD = 2
+OP_DESCENT = 3
+OP_SLICE = 4
+OP_SELECT = 5
+OP_FILTER = 6
+OP_SORT = 7
+OP_FIELDS = 8
+
+# sentinel for dict lookups, so that stored None values are still found;
+# also marks the recursive descent memo entries on the traversal stack
+_MISSING = object()
+_MEMO_ENTER = 0
+_MEMO_LEAVE = 1
+_MEMO_REPLAY = 2
+
+# opcodes `JSONPath._codegen` turns into nested loops
+_CODEGEN_OPS = frozenset(
+    (OP_KEY, OP_INDEX, OP_WILDCARD, OP_DESCENT, OP_SLICE, OP_SELECT, OP_FILTER)
+)
+# final steps whose VALUE matches are stored with a single extend
+_BATCH_OPS = frozenset((OP_WILDCARD, OP_SLICE, OP_SELECT))
+
+# the inside of a bracket, which may hold balanced brackets of its own, as in
+# `[?(@.a[0].b > 1)]`, up to three levels deep
+_BRACKET_CONTENT = r"(?:'[^']*'|`[^`]*`|[^\[\]'`])*"
+for _ in range(3):
+    _BRACKET_CONTENT = r"(?:'[^']*'|`[^`]*`|\[%s\]|[^\[\]'`])*" % _BRACKET_CONTENT
+
+
 class JSONPath:
     RESULT_TYPE = {
         "VALUE": "A list of specific values.",
@@ -50,42 +105,83 @@ class JSONPath:
 
     # common patterns
     SEP = ";"
-    REP_DOUBLEDOT = re.compile(r"\.\.")
-    REP_DOT = re.compile(r"(?<!\.)\.(?!\.)")
-
-    # save special patterns
-    REP_GET_QUOTE = re.compile(r"['](.*?)[']")
-    REP_PUT_QUOTE = re.compile(r"#Q(\d+)")
-    REP_GET_BACKQUOTE = re.compile(r"[`](.*?)[`]")
-    REP_PUT_BACKQUOTE = re.compile(r"#BQ(\d+)")
-    REP_GET_BRACKET = re.compile(r"[\[](.*?)[\]]")
-    REP_PUT_BRACKET = re.compile(r"#B(\d+)")
-    REP_GET_PAREN = re.compile(r"[\(](.*?)[\)]")
-    REP_PUT_PAREN = re.compile(r"#P(\d+)")
+
+    # tokenizer: quoted, backquoted, bracketed and parenthesized parts are
+    # kept whole, so the dots inside them never split a segment
+    REP_QUOTE = re.compile(r"'(.*?)'")
+    REP_TOKEN = re.compile(
+        r"'(?P<quote>[^']*)'"
+        r"|(?P<backquote>`[^`]*`)"
+        r"|\[(?P<bracket>%s)\]"
+        r"|(?P<paren>\((?:'[^']*'|`[^`]*`|[^)'`])*\))"
+        r"|(?P<dot>\.\.?)"
+        r"|(?P<other>[^.\[('`]+|.)" % _BRACKET_CONTENT
+    )
+
+    # filters: `@` chains are rewritten, string literals are left as they are.
+    # This works on the text rather than the AST, since a custom eval_func is
+    # handed the rewritten source, and ast.unparse needs Python 3.9
+    REP_FILTER_OBJ = re.compile(
+        r"(?P<string>\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')"
+        r"|@(?P<chain>(?:\.\w+|\[[^\]]*\])*)(?P<call>\s*\()?"
+    )
+    REP_FILTER_PART = re.compile(r"\.(\w+)|\[([^\]]*)\]")
 
     # operators
     REP_SLICE_CONTENT = re.compile(r"^(-?\d*)?:(-?\d*)?(:-?\d*)?$")
     REP_SELECT_CONTENT = re.compile(r"^([\w.']+)(, ?[\w.']+)+$")
-    REP_FILTER_CONTENT = re.compile(
-        r"@\.(.*?)(?=<=|>=|==|!=|>|<| in| not| is)|len\(@\.(.*?)\)"
+
+    __slots__ = (
+        "segments",
+        "ops",
+        "lpath",
+        "memoize",
+        "programs",
     )
 
-    # annotations
-    f: list
+    # annotations; all of these are shared by the instances of an expression.
+    # parse() only ever fills `programs` lazily, with values that come out the
+    # same whichever parse stores them, so sharing needs no locking
     segments: list
+    ops: list
     lpath: int
-    subx = defaultdict(list)
-    result: list
-    result_type: str
-    eval_func: callable
+    memoize: frozenset
+    programs: dict
 
     def __init__(self, expr: str):
-        expr = self._parse_expr(expr)
-        self.segments = expr.split(JSONPath.SEP)
-        self.lpath = len(self.segments)
-        logger.debug(f"segments  : {self.segments}")
+        # compiled once per distinct expression, and shared by its instances
+        (
+            self.segments,
+            self.lpath,
+            self.ops,
+            self.memoize,
+            self.programs,
+        ) = _compile_expr(expr)
 
-        self.caller_globals = sys._getframe(1).f_globals
+    @staticmethod
+    def _compile(expr: str) -> tuple:
+        """Parse expr into (segments, lpath, ops, memoize, programs)."""
+        segments = JSONPath._parse_expr(expr)
+        lpath = len(segments)
+        logger.debug("segments  : %s", segments)
+        ops = [JSONPath._compile_step(step) for step in segments]
+        # the scalars below a `..` can be skipped, unless the next step is one
+        # that also acts on (or rejects) scalars
+        for j, (op, step, _) in enumerate(ops):
+            if op == OP_DESCENT:
+                nxt = ops[j + 1][0] if j + 1 < lpath else None
+                scalars = nxt in (None, OP_DESCENT, OP_SORT, OP_FIELDS)
+                ops[j] = (op, step, scalars)
+        # a `..` below another `..` revisits the same subtrees, which is worth
+        # memoizing; the first one only ever walks each subtree once
+        descents = [i for i, (op, _, _) in enumerate(ops) if op == OP_DESCENT]
+        memoize = frozenset(descents[1:])
+        # functions generated by `_codegen`, per result type, see `parse`;
+        # a plain chain of keys and indexes gets its function right away
+        programs = {}
+        if all(op == OP_KEY or op == OP_INDEX for op, _, _ in ops):
+            programs = {m: JSONPath._follow(ops, m) for m in (False, True)}
+        return segments, lpath, ops, memoize, programs
 
     def parse(self, obj, result_type="VALUE", eval_func=eval):
         if not isinstance(obj, (list, dict)):
@@ -95,97 +191,237 @@ class JSONPath:
             raise ValueError(
                 f"result_type must be one of {tuple(JSONPath.RESULT_TYPE.keys())}"
             )
-        self.result_type = result_type
-        self.eval_func = eval_func
-
-        self.result = []
-        self._trace(obj, 0, "$")
-
-        return self.result
+        match = self._matcher(eval_func, self.ops)
+
+        result = []
+        value_mode = result_type == "VALUE"
+        # the first parse of an expression is interpreted by `_trace`; code is
+        # only generated for one that is parsed again. `programs` is shared by
+        # all instances of the expression, so this counts parses across all of
+        # them and across threads; two threads may both generate the code, and
+        # either result does
+        programs = self.programs
+        run = programs.get(value_mode)
+        if run is _MISSING:
+            run = programs[value_mode] = self._codegen(value_mode)
+        elif run is None and value_mode not in programs:
+            programs[value_mode] = _MISSING
+        # debug runs go through `_trace`, which logs every match
+        if run is None or logger.isEnabledFor(logging.DEBUG):
+            self._trace(obj, 0, None if value_mode else ("$",), match, result)
+        else:
+            run(obj, ("$",), result.append, result.extend, match)
+
+        return result
 
     def search(self, obj, result_type="VALUE"):
         return self.parse(obj, result_type)
 
-    def _parse_expr(self, expr):
-        logger.debug(f"before expr : {expr}")
-        # pick up special patterns
-        expr = JSONPath.REP_GET_QUOTE.sub(self._get_quote, expr)
-        expr = JSONPath.REP_GET_BACKQUOTE.sub(self._get_backquote, expr)
-        expr = JSONPath.REP_GET_BRACKET.sub(self._get_bracket, expr)
-        expr = JSONPath.REP_GET_PAREN.sub(self._get_paren, expr)
-        # split
-        expr = JSONPath.REP_DOUBLEDOT.sub(f"{JSONPath.SEP}..{JSONPath.SEP}", expr)
-        expr = JSONPath.REP_DOT.sub(JSONPath.SEP, expr)
-        # put back
-        expr = JSONPath.REP_PUT_PAREN.sub(self._put_paren, expr)
-        expr = JSONPath.REP_PUT_BRACKET.sub(self._put_bracket, expr)
-        expr = JSONPath.REP_PUT_BACKQUOTE.sub(self._put_backquote, expr)
-        expr = JSONPath.REP_PUT_QUOTE.sub(self._put_quote, expr)
-        if expr.startswith("$;"):
-            expr = expr[2:]
-
-        logger.debug(f"after expr  : {expr}")
-        return expr
-
-    # TODO abstract get and put procedures
-    def _get_quote(self, m):
-        n = len(self.subx["#Q"])
-        self.subx["#Q"].append(m.group(1))
-        return f"#Q{n}"
-
-    def _put_quote(self, m):
-        return self.subx["#Q"][int(m.group(1))]
-
-    def _get_backquote(self, m):
-        n = len(self.subx["#BQ"])
-        self.subx["#BQ"].append(m.group(1))
-        return f"`#BQ{n}`"
-
-    def _put_backquote(self, m):
-        return self.subx["#BQ"][int(m.group(1))]
-
-    def _get_bracket(self, m):
-        n = len(self.subx["#B"])
-        self.subx["#B"].append(m.group(1))
-        return f".#B{n}"
-
-    def _put_bracket(self, m):
-        return self.subx["#B"][int(m.group(1))]
-
-    def _get_paren(self, m):
-        n = len(self.subx["#P"])
-        self.subx["#P"].append(m.group(1))
-        return f"(#P{n})"
-
-    def _put_paren(self, m):
-        return self.subx["#P"][int(m.group(1))]
+    @staticmethod
+    def _parse_expr(expr):
+        """Split expr into segments in a single left-to-right pass."""
+        logger.debug("before expr : %s", expr)
+        segments = []
+        if not any(c in expr for c in "'`[("):
+            # nothing is quoted or bracketed: splitting on dots is enough
+            for part in expr.split(".."):
+                segments.append("..")
+                segments.extend(part.split("."))
+            del segments[0]
+        else:
+            seg = ""
+            dot = None
+            for m in JSONPath.REP_TOKEN.finditer(expr):
+                kind = m.lastgroup
+                if kind == "dot":
+                    segments.append(seg)
+                    if m.group() == "..":
+                        segments.append("..")
+                    seg = ""
+                elif kind == "bracket":
+                    # `a[b]` is the same as `a.b`, so `a.[b]` is `a..b`
+                    if dot == ".":
+                        segments.append("..")
+                    else:
+                        segments.append(seg)
+                    seg = JSONPath.REP_QUOTE.sub(r"\1", m.group(kind))
+                elif kind == "paren":
+                    seg += JSONPath.REP_QUOTE.sub(r"\1", m.group(kind))
+                else:
+                    seg += m.group(kind)
+                dot = m.group() if kind == "dot" else None
+            segments.append(seg)
+        if segments[0] == "$" and len(segments) > 1:
+            del segments[0]
+
+        logger.debug("after expr  : %s", segments)
+        return segments
+
+    @staticmethod
+    def _compile_step(step: str):
+        """Classify a segment once, so that `_trace` doesn't re-parse it on every node.
+
+        Returns:
+            tuple: (opcode, raw step, pre-parsed argument of the opcode)
+        """
+        if step == "*":
+            return OP_WILDCARD, step, None
+        if step == "..":
+            return OP_DESCENT, step, None
+        if step.isdigit():
+            return OP_INDEX, step, int(step)
+        if JSONPath.REP_SLICE_CONTENT.fullmatch(step):
+            return OP_SLICE, step, JSONPath._parse_slice(step)
+        if JSONPath.REP_SELECT_CONTENT.fullmatch(step):
+            return OP_SELECT, step, step.split(",")
+        if step.startswith("?(") and step.endswith(")"):
+            return OP_FILTER, step, JSONPath._rewrite_filter(step[2:-1])
+        if step.startswith("/(") and step.endswith(")"):
+            return OP_SORT, step, JSONPath._parse_sortbys(step[2:-1])
+        if step.startswith("(") and step.endswith(")"):
+            fields = step[1:-1].split(",")
+            return OP_FIELDS, step, [(f, tuple(f.split("."))) for f in fields]
+        return OP_KEY, step, None
+
+    @staticmethod
+    def _parse_slice(step: str) -> slice:
+        start, stop, stride = JSONPath.REP_SLICE_CONTENT.fullmatch(step).groups()
+        stride = stride[1:] if stride else None
+        return slice(
+            int(start) if start else None,
+            int(stop) if stop else None,
+            int(stride) if stride else None,
+        )
+
+    @staticmethod
+    def _rewrite_filter(body: str) -> str:
+        """Rewrite a filter body into Python source over `__obj`, the current object.
+
+        `@.a[0].b` becomes `__obj["a"][0]["b"]`; in `@.name.upper()` the last name
+        stays a method of the value.
+        """
+        return JSONPath.REP_FILTER_OBJ.sub(JSONPath._gen_obj, body)
 
     @staticmethod
     def _gen_obj(m):
+        if m.group("string"):
+            return m.group()
+        parts = JSONPath.REP_FILTER_PART.findall(m.group("chain"))
+        call = m.group("call") or ""
+        method = "." + parts.pop()[0] if call and parts and parts[-1][0] else ""
         ret = "__obj"
-        for e in m.group(1).split("."):
-            ret += '["%s"]' % e
-        return ret
+        for key, index in parts:
+            if key:
+                ret += '["%s"]' % key
+            else:
+                ret += "[%s]" % JSONPath._rewrite_filter(index)
+        return ret + method + call
+
+    @staticmethod
+    @lru_cache(maxsize=_cache_size)
+    def _compile_filter(source: str):
+        """Compile filter source from `_rewrite_filter` into a one-argument function.
+
+        Cached by source, so that expressions sharing a filter compile it once.
+        """
+        lam = ast.parse("lambda __obj: None", mode="eval")
+        lam.body.body = ast.parse(source.strip(), mode="eval").body
+        # module globals, as the filters of a plain eval() inside parse() had
+        return eval(builtins.compile(lam, "<jsonpath-filter>", "eval"), globals())
 
     @staticmethod
-    def _traverse(f, obj, i: int, path: str, *args):
+    def _children(obj, i: int, path: tuple) -> list:
+        """Return the children of obj as work items for step i, in document order."""
         if isinstance(obj, list):
-            for idx, v in enumerate(obj):
-                f(v, i, f"{path}{JSONPath.SEP}{idx}", *args)
-        elif isinstance(obj, dict):
-            for k, v in obj.items():
-                f(v, i, f"{path}{JSONPath.SEP}{k}", *args)
+            return [(v, i, path and path + (str(idx),)) for idx, v in enumerate(obj)]
+        if isinstance(obj, dict):
+            return [(v, i, path and path + (str(k),)) for k, v in obj.items()]
+        return []
+
+    @staticmethod
+    def _subnodes(obj, path: tuple, scalars: bool) -> list:
+        """Return the children of obj as (node, path) pairs, in reverse document order.
+
+        Scalar children are left out unless scalars is true.
+        """
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        else:
+            return []
+        if scalars:
+            sub = [(v, path and path + (str(k),)) for k, v in items]
+        else:
+            sub = [
+                (v, path and path + (str(k),))
+                for k, v in items
+                if isinstance(v, (dict, list))
+            ]
+        sub.reverse()
+        return sub
+
+    @staticmethod
+    def _descendants(obj, path: tuple, scalars: bool) -> list:
+        """Return obj and its descendants as (node, path) pairs, in document order."""
+        subnodes = JSONPath._subnodes
+        nodes = []
+        walk = [(obj, path)]
+        while walk:
+            obj, path = walk.pop()
+            nodes.append((obj, path))
+            walk.extend(subnodes(obj, path, scalars))
+        return nodes
+
+    @staticmethod
+    def _descendant_values(obj, scalars: bool) -> list:
+        """Same as `_descendants`, for VALUE mode: the nodes alone, without paths."""
+        nodes = []
+        walk = [obj]
+        while walk:
+            obj = walk.pop()
+            nodes.append(obj)
+            if isinstance(obj, dict):
+                sub = obj.values()
+            elif isinstance(obj, list):
+                sub = obj
+            else:
+                continue
+            if scalars:
+                sub = list(sub)
+            else:
+                sub = [v for v in sub if isinstance(v, (dict, list))]
+            sub.reverse()
+            walk.extend(sub)
+        return nodes
 
     @staticmethod
-    def _getattr(obj: dict, path: str, *, convert_number_str=False):
+    def _getattr(obj: dict, keys: tuple):
         r = obj
-        for k in path.split("."):
-            try:
-                r = r.get(k)
-            except (AttributeError, KeyError) as err:
-                logger.error(err)
+        for k in keys:
+            if not isinstance(r, dict):
                 return None
-        if convert_number_str and isinstance(r, str):
+            r = r.get(k)
+        return r
+
+    @staticmethod
+    def _parse_sortbys(sortbys: str) -> list:
+        """Parse `a,~b.c` into [(True, ("b", "c")), (False, ("a",))].
+
+        The fields come out last first, which is the order the stable sorts run in.
+        """
+        sorts = []
+        for sortby in sortbys.split(",")[::-1]:
+            reverse = sortby.startswith("~")
+            if reverse:
+                sortby = sortby[1:]
+            sorts.append((reverse, tuple(sortby.split("."))))
+        return sorts
+
+    @staticmethod
+    def _sort_key(obj, keys: tuple):
+        r = JSONPath._getattr(obj, keys)
+        if isinstance(r, str):
             try:
                 if r.isdigit():
                     return int(r)
@@ -195,137 +431,387 @@ class JSONPath:
         return r
 
     @staticmethod
-    def _sorter(obj, sortbys):
-        for sortby in sortbys.split(",")[::-1]:
-            if sortby.startswith("~"):
-                obj.sort(
-                    key=lambda t, k=sortby: JSONPath._getattr(
-                        t[1], k[1:], convert_number_str=True
-                    ),
-                    reverse=True,
-                )
-            else:
-                obj.sort(
-                    key=lambda t, k=sortby: JSONPath._getattr(
-                        t[1], k, convert_number_str=True
-                    )
-                )
+    def _sorter(obj, sorts) -> list:
+        """Return the indexes of a list, or the keys of a dict, in sorted order."""
+        order = list(range(len(obj))) if isinstance(obj, list) else list(obj)
+        for reverse, keys in sorts:
+            order.sort(
+                key=lambda k, keys=keys: JSONPath._sort_key(obj[k], keys),
+                reverse=reverse,
+            )
+        return order
 
-    def _filter(self, obj, i: int, path: str, step: str):
-        r = False
-        try:
-            r = self.eval_func(step, None, {"__obj": obj})
-        except Exception as err:
-            logger.error(err)
-        if r:
-            self._trace(obj, i, path)
+    @staticmethod
+    def _matcher(eval_func, ops: list):
+        """Return match(obj, source) -> bool, which runs a rewritten filter on obj.
 
-    def _trace(self, obj, i: int, path):
-        """Perform operation on object.
+        Custom evaluators get the source, as `eval_func(source, None, locals)`; the
+        default `eval` runs functions compiled once from it instead.
 
-        Args:
-            obj ([type]): current operating object
-            i (int): current operation specified by index in self.segments
+        A filter that raises, typically on a missing key, simply doesn't match;
+        that is routine, so it is only logged at debug level.
         """
+        if eval_func is eval:
+            predicates = {}
+            for op, step, arg in ops:
+                if op == OP_FILTER:
+                    try:
+                        predicates[arg] = JSONPath._compile_filter(arg)
+                    except SyntaxError as err:
+                        raise ExprSyntaxError(
+                            f"invalid filter expression: {step}"
+                        ) from err
+
+            def match(obj, arg):
+                try:
+                    return predicates[arg](obj)
+                except Exception as err:
+                    logger.debug("filter failed: %r", err)
+                    return False
+
+            return match
+
+        # one locals dict for the whole parse, rather than one per node
+        scope = {"__obj": None}
+
+        def match(obj, arg):
+            scope["__obj"] = obj
+            try:
+                return eval_func(arg, None, scope)
+            except Exception as err:
+                logger.debug("filter failed: %r", err)
+                return False
 
-        # store
-        if i >= self.lpath:
-            if self.result_type == "VALUE":
-                self.result.append(obj)
-            elif self.result_type == "PATH":
-                self.result.append(path)
-            logger.debug(f"path: {path} | value: {obj}")
-            return
-
-        step = self.segments[i]
-
-        # wildcard
-        if step == "*":
-            self._traverse(self._trace, obj, i + 1, path)
-            return
+        return match
 
-        # recursive descent
-        if step == "..":
-            self._trace(obj, i + 1, path)
-            self._traverse(self._trace, obj, i, path)
-            return
-
-        # get value from list
-        if isinstance(obj, list) and step.isdigit():
-            ikey = int(step)
-            if ikey < len(obj):
-                self._trace(obj[ikey], i + 1, f"{path}{JSONPath.SEP}{step}")
-            return
-
-        # get value from dict
-        if isinstance(obj, dict) and step in obj:
-            self._trace(obj[step], i + 1, f"{path}{JSONPath.SEP}{step}")
-            return
-
-        # slice
-        if isinstance(obj, list) and JSONPath.REP_SLICE_CONTENT.fullmatch(step):
-            obj = list(enumerate(obj))
-            vals = self.eval_func(f"obj[{step}]")
-            for idx, v in vals:
-                self._trace(v, i + 1, f"{path}{JSONPath.SEP}{idx}")
-            return
-
-        # select
-        if isinstance(obj, dict) and JSONPath.REP_SELECT_CONTENT.fullmatch(step):
-            for k in step.split(","):
-                if k in obj:
-                    self._trace(obj[k], i + 1, f"{path}{JSONPath.SEP}{k}")
-            return
-
-        # filter
-        if step.startswith("?(") and step.endswith(")"):
-            step = step[2:-1]
-            step = JSONPath.REP_FILTER_CONTENT.sub(self._gen_obj, step)
-            self._traverse(self._filter, obj, i + 1, path, step)
-            return
+    @staticmethod
+    def _follow(ops: list, value_mode: bool):
+        """Return a `run` function, as `_codegen` would, for keys and indexes only.
 
-        # sorter
-        if step.startswith("/(") and step.endswith(")"):
-            if isinstance(obj, list):
-                obj = list(enumerate(obj))
-                self._sorter(obj, step[2:-1])
-                for idx, v in obj:
-                    self._trace(v, i + 1, f"{path}{JSONPath.SEP}{idx}")
-            elif isinstance(obj, dict):
-                obj = list(obj.items())
-                self._sorter(obj, step[2:-1])
-                for k, v in obj:
-                    self._trace(v, i + 1, f"{path}{JSONPath.SEP}{k}")
+        Such an expression matches at most one node, whose path is known upfront.
+        """
+        steps = [(step, arg) for _, step, arg in ops]
+        path = JSONPath.SEP.join(["$"] + [step for step, _ in steps])
+
+        def run(obj, p0, append, extend, match):
+            for step, index in steps:
+                if isinstance(obj, dict):
+                    obj = obj.get(step, _MISSING)
+                    if obj is _MISSING:
+                        return
+                elif index is not None and isinstance(obj, list) and index < len(obj):
+                    obj = obj[index]
+                else:
+                    return
+            append(obj if value_mode else path)
+
+        return run
+
+    def _codegen(self, value_mode: bool):
+        """Generate a function that runs the whole expression as nested loops.
+
+        `$.a[*].b` becomes roughly::
+
+            def run(o0, p0, append, extend, match):
+                if isinstance(o0, dict):
+                    o1 = o0.get("a", _MISSING)
+                ...
+                    for k2, o2 in it1:
+                        ...
+                                append(o3)
+
+        Only keys, indexes, wildcards, slices, selects, filters and a single
+        `..` are generated; returns None for other expressions, which `_trace`
+        runs, along with the memo nested `..` steps need.
+        """
+        if self.memoize or not all(op in _CODEGEN_OPS for op, _, _ in self.ops):
+            return None
+        ns = {
+            "_MISSING": _MISSING,
+            "join": JSONPath.SEP.join,
+            "descendants": self._descendants,
+            "descendant_values": self._descendant_values,
+        }
+        src = ["def run(o0, p0, append, extend, match):"]
+        pad = "    "
+        stored = False
+        for j, (op, step, arg) in enumerate(self.ops):
+            o, p, s, a, it = f"o{j}", f"p{j}", f"s{j}", f"a{j}", f"it{j}"
+            o_, p_, k_ = f"o{j + 1}", f"p{j + 1}", f"k{j + 1}"
+            ns[s] = step
+            ns[a] = arg
+
+            if op == OP_KEY or op == OP_INDEX:
+                src.append(f"{pad}if isinstance({o}, dict):")
+                src.append(f"{pad}    {o_} = {o}.get({s}, _MISSING)")
+                if op == OP_INDEX:
+                    src.append(f"{pad}elif isinstance({o}, list) and {a} < len({o}):")
+                    src.append(f"{pad}    {o_} = {o}[{a}]")
+                src.append(f"{pad}else:")
+                src.append(f"{pad}    {o_} = _MISSING")
+                src.append(f"{pad}if {o_} is not _MISSING:")
+                pad += "    "
+                if not value_mode:
+                    src.append(f"{pad}{p_} = {p} + ({s},)")
+                continue
+
+            if op == OP_DESCENT:
+                if value_mode:
+                    src.append(f"{pad}for {o_} in descendant_values({o}, {a}):")
+                else:
+                    src.append(f"{pad}for {o_}, {p_} in descendants({o}, {p}, {a}):")
+                pad += "    "
+                continue
+
+            # the values of a final wildcard, slice or select are stored in one go
+            if value_mode and j == self.lpath - 1 and op in _BATCH_OPS:
+                if op == OP_WILDCARD:
+                    src.append(f"{pad}if isinstance({o}, dict):")
+                    src.append(f"{pad}    extend({o}.values())")
+                    src.append(f"{pad}elif isinstance({o}, list):")
+                    src.append(f"{pad}    extend({o})")
+                elif op == OP_SELECT:
+                    src.append(f"{pad}if isinstance({o}, dict):")
+                    src.append(f"{pad}    if {s} in {o}:")
+                    src.append(f"{pad}        append({o}[{s}])")
+                    src.append(f"{pad}    else:")
+                    src.append(
+                        f"{pad}        extend([{o}[k] for k in {a} if k in {o}])"
+                    )
+                else:
+                    src.append(f"{pad}if isinstance({o}, dict):")
+                    src.append(f"{pad}    if {s} in {o}:")
+                    src.append(f"{pad}        append({o}[{s}])")
+                    src.append(f"{pad}elif isinstance({o}, list):")
+                    src.append(f"{pad}    extend({o}[{a}])")
+                stored = True
+                break
+
+            if op == OP_WILDCARD:
+                src.append(f"{pad}if isinstance({o}, dict):")
+                src.append(f"{pad}    {it} = {o}.items()")
             else:
-                raise ExprSyntaxError("sorter must acting on list or dict")
-            return
+                # a dict key that merely looks like an operator still wins
+                src.append(f"{pad}if isinstance({o}, dict) and {s} in {o}:")
+                src.append(f"{pad}    {it} = (({s}, {o}[{s}]),)")
+                if op == OP_SELECT:
+                    src.append(f"{pad}elif isinstance({o}, dict):")
+                    src.append(
+                        f"{pad}    {it} = [(k, {o}[k]) for k in {a} if k in {o}]"
+                    )
+                elif op == OP_FILTER:
+                    src.append(f"{pad}elif isinstance({o}, dict):")
+                    src.append(
+                        f"{pad}    {it} = [(k, v) for k, v in {o}.items() if match(v, {a})]"
+                    )
+            if op == OP_WILDCARD:
+                src.append(f"{pad}elif isinstance({o}, list):")
+                src.append(f"{pad}    {it} = enumerate({o})")
+            elif op == OP_SLICE:
+                src.append(f"{pad}elif isinstance({o}, list):")
+                src.append(
+                    f"{pad}    {it} = [(k, {o}[k]) for k in range(*{a}.indices(len({o})))]"
+                )
+            elif op == OP_FILTER:
+                src.append(f"{pad}elif isinstance({o}, list):")
+                src.append(
+                    f"{pad}    {it} = [(k, v) for k, v in enumerate({o}) if match(v, {a})]"
+                )
+            src.append(f"{pad}else:")
+            src.append(f"{pad}    {it} = ()")
+            src.append(f"{pad}for {k_}, {o_} in {it}:")
+            pad += "    "
+            if not value_mode:
+                src.append(f"{pad}{p_} = {p} + (str({k_}),)")
+
+        if not stored:
+            value = f"o{self.lpath}" if value_mode else f"join(p{self.lpath})"
+            src.append(f"{pad}append({value})")
+        exec(builtins.compile("\n".join(src), "<jsonpath>", "exec"), ns)
+        return ns["run"]
+
+    def _trace(self, obj, i: int, path: tuple, match, result: list):
+        """Perform operations on object.
+
+        The traversal runs on an explicit stack of (obj, i, path) work items
+        rather than recursing per node; children are pushed in reverse so that
+        results still come out in document order.
 
-        # field-extractor
-        if step.startswith("(") and step.endswith(")"):
+        Args:
+            obj ([type]): current operating object
+            i (int): current operation specified by index in self.segments
+            path (tuple): keys leading to obj, joined only when stored;
+                None in VALUE mode, where no path is ever built
+            match (callable): filter runner returned by `_matcher`
+            result (list): where matches are stored
+        """
+        ops = self.ops
+        lpath = self.lpath
+        # the store step, bound once: paths are None exactly in VALUE mode
+        store = result.append
+        join = JSONPath.SEP.join
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # nested `..` steps revisit the same subtrees, see below
+        memoize = self.memoize
+        memo = {}
+        stack = [(obj, i, path)]
+        push = stack.append
+        children = self._children
+
+        while stack:
+            obj, i, path = stack.pop()
+
+            # memo bookkeeping queued by recursive descent
+            if obj is _MISSING:
+                if i == _MEMO_ENTER:
+                    path[2] = len(result)
+                elif i == _MEMO_LEAVE:
+                    key, root, start = path
+                    memo[key] = (root, result[start:])
+                else:
+                    result.extend(path)
+                continue
+
+            # store
+            if i >= lpath:
+                store(obj if path is None else join(path))
+                if debug:
+                    logger.debug("path: %s | value: %s", path and join(path), obj)
+                continue
+
+            op, step, arg = ops[i]
+
+            # get value from dict
+            if op == OP_KEY:
+                if isinstance(obj, dict):
+                    v = obj.get(step, _MISSING)
+                    if v is not _MISSING:
+                        push((v, i + 1, path and path + (step,)))
+                continue
+
+            # get value from list
+            if op == OP_INDEX:
+                if isinstance(obj, list):
+                    if arg < len(obj):
+                        push((obj[arg], i + 1, path and path + (step,)))
+                elif isinstance(obj, dict):
+                    v = obj.get(step, _MISSING)
+                    if v is not _MISSING:
+                        push((v, i + 1, path and path + (step,)))
+                continue
+
+            # wildcard
+            if op == OP_WILDCARD:
+                stack.extend(reversed(children(obj, i + 1, path)))
+                continue
+
+            # recursive descent: queue obj and all its descendants for the next
+            # step at once, in document order
+            if op == OP_DESCENT:
+                subnodes = self._subnodes
+                use_memo = i in memoize
+                i += 1
+                nodes = []
+                walk = [(obj, path)]
+                while walk:
+                    obj, path = walk.pop()
+                    if obj is _MISSING:
+                        nodes.append((_MISSING, _MEMO_LEAVE, path))
+                        continue
+                    if use_memo:
+                        # the results of a subtree only depend on its root and the
+                        # root's path, so a subtree reached again by an enclosing
+                        # `..` is replayed; the memo keeps the root alive, so that
+                        # its id can't be reused
+                        key = (id(obj), i, path)
+                        hit = memo.get(key)
+                        if hit is not None:
+                            nodes.append((_MISSING, _MEMO_REPLAY, hit[1]))
+                            continue
+                        entry = [key, obj, 0]
+                        nodes.append((_MISSING, _MEMO_ENTER, entry))
+                        walk.append((_MISSING, entry))
+                    nodes.append((obj, i, path))
+                    walk.extend(subnodes(obj, path, arg))
+                nodes.reverse()
+                stack.extend(nodes)
+                continue
+
+            # a dict key that merely looks like an operator still wins
             if isinstance(obj, dict):
-                obj_ = {}
-                for k in step[1:-1].split(","):
-                    obj_[k] = self._getattr(obj, k)
-                self._trace(obj_, i + 1, path)
-            else:
-                raise ExprSyntaxError("field-extractor must acting on dict")
-
-            return
+                v = obj.get(step, _MISSING)
+                if v is not _MISSING:
+                    push((v, i + 1, path and path + (step,)))
+                    continue
+
+            # slice
+            if op == OP_SLICE:
+                if isinstance(obj, list):
+                    for idx in reversed(range(*arg.indices(len(obj)))):
+                        push((obj[idx], i + 1, path and path + (str(idx),)))
+                continue
+
+            # select
+            if op == OP_SELECT:
+                if isinstance(obj, dict):
+                    for k in reversed(arg):
+                        if k in obj:
+                            push((obj[k], i + 1, path and path + (str(k),)))
+                continue
+
+            # filter
+            if op == OP_FILTER:
+                matched = [c for c in children(obj, i + 1, path) if match(c[0], arg)]
+                stack.extend(reversed(matched))
+                continue
+
+            # sorter
+            if op == OP_SORT:
+                if isinstance(obj, (list, dict)):
+                    for k in reversed(self._sorter(obj, arg)):
+                        push((obj[k], i + 1, path and path + (str(k),)))
+                else:
+                    raise ExprSyntaxError("sorter must acting on list or dict")
+                continue
+
+            # field-extractor
+            if op == OP_FIELDS:
+                if isinstance(obj, dict):
+                    obj_ = {}
+                    for field, keys in arg:
+                        obj_[field] = self._getattr(obj, keys)
+                    push((obj_, i + 1, path))
+                else:
+                    raise ExprSyntaxError("field-extractor must acting on dict")
+
+
+# global caches of compiled expressions, see `_cache_size`
+_compile_expr = lru_cache(maxsize=_cache_size)(JSONPath._compile)
+_compile_cached = lru_cache(maxsize=_cache_size)(JSONPath)
 
 
 def compile(expr):
-    return JSONPath(expr)
+    return _compile_cached(expr)
 
 
-# global cache
-_jsonpath_cache = {}
+def search(expr, data):
+    return _compile_cached(expr).parse(data)
 
 
-def search(expr, data):
-    global _jsonpath_cache
-    if expr not in _jsonpath_cache:
-        _jsonpath_cache[expr] = JSONPath(expr)
-    return _jsonpath_cache[expr].parse(data)
+def cache_clear():
+    """Drop every compiled expression kept by `compile`, `search` and `JSONPath`."""
+    _compile_cached.cache_clear()
+    _compile_expr.cache_clear()
+    JSONPath._compile_filter.cache_clear()
+
+
+def cache_info():
+    """Report hits, misses and size of the cache behind `compile` and `search`.
+
+    The caches of parsed expressions and compiled filters that `JSONPath` itself
+    uses are not included.
+    """
+    return _compile_cached.cache_info()
 
 
 if __name__ == "__main__":
@@ -42,6 +42,7 @@ with open("test/data/2.json", "rb") as f:
         TestCase("$.book[/(price)].price", data, [8.95, 8.99, 12.99, 22.99]),
         TestCase("$.book[/(~price)].price", data, [22.99, 12.99, 8.99, 8.95]),
         TestCase("$.book[/(category,price)].price", data, [8.99, 12.99, 22.99, 8.95]),
+        TestCase("$.book[/(category,~price)].price", data, [22.99, 12.99, 8.99, 8.95]),
         TestCase(
             "$.book[/(brand.version)].brand.version",
             data,
@@ -1,13 +1,197 @@
-from jsonpath import JSONPath
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import jsonpath
+from jsonpath import ExprSyntaxError, JSONPath
+
+from test.conftest import data
 
 
 def test_value_cases(value_cases):
     print(value_cases.expr)
-    r = JSONPath(value_cases.expr).parse(value_cases.data)
-    assert r == value_cases.result
+    jp = JSONPath(value_cases.expr)
+    # once interpreted, then through the generated function
+    for _ in range(2):
+        r = jp.parse(value_cases.data)
+        assert r == value_cases.result
 
 
 def test_path_cases(path_cases):
     print(path_cases.expr)
-    r = JSONPath(path_cases.expr).parse(path_cases.data, "PATH")
-    assert r == path_cases.result
+    jp = JSONPath(path_cases.expr)
+    for _ in range(2):
+        r = jp.parse(path_cases.data, "PATH")
+        assert r == path_cases.result
+
+
+def test_interpreted_cases(value_cases, caplog):
+    # debug logging bypasses the generated functions
+    caplog.set_level(logging.DEBUG, logger="jsonpath")
+    r = JSONPath(value_cases.expr).parse(value_cases.data)
+    assert r == value_cases.result
+
+
+def test_compile_cache():
+    jsonpath.cache_clear()
+    jp = jsonpath.compile("$.book[*].price")
+    assert jsonpath.compile("$.book[*].price") is jp
+    assert jsonpath.search("$.book[*].price", data) == jp.parse(data)
+    assert jsonpath.cache_info().hits == 2
+    jsonpath.cache_clear()
+    jp2 = jsonpath.compile("$.book[*].price")
+    assert jp2 is not jp
+    # plain instances share the compiled parts too
+    assert JSONPath("$.book[*].price").ops is jp2.ops
+    # including the generated code, whichever instance parsed before
+    JSONPath("$.book[*].price").parse(data)
+    JSONPath("$.book[*].price").parse(data)
+    run = JSONPath("$.book[*].price").programs[True]
+    assert run.__qualname__ == "run"
+    assert jp2.programs[True] is run
+    # and expressions with the same filter body share its compiled form
+    f1 = JSONPath("$.book[?(@.price<10)].title").ops[-2][2]
+    f2 = JSONPath("$.bicycle[?(@.price<10)]").ops[-1][2]
+    assert JSONPath._compile_filter(f1) is JSONPath._compile_filter(f2)
+    assert JSONPath._compile_filter.cache_info().maxsize == jsonpath._cache_size
+
+
+def test_cache_size_env(monkeypatch):
+    cases = [("16", 16), ("0", 0), ("None", None), ("x", 1024), ("-1", 1024)]
+    for value, size in cases:
+        monkeypatch.setenv("JSONPATH_CACHE", value)
+        assert jsonpath._env_cache_size() == size
+    monkeypatch.delenv("JSONPATH_CACHE")
+    assert jsonpath._env_cache_size() == 1024
+
+
+def test_invalid_filter():
+    jp = JSONPath("$.book[?(@.price>)]")
+    with pytest.raises(ExprSyntaxError):
+        jp.parse(data)
+    # a custom evaluator decides for itself what it accepts
+    assert jp.parse(data, eval_func=lambda *args: True) == data["book"]
+
+
+def test_recursive_descent_deep_nesting():
+    obj = {"x": 0}
+    for n in range(1, 5000):
+        obj = {"a": obj, "x": n}
+    assert JSONPath("$..x").parse(obj) == list(range(4999, -1, -1))
+
+
+def test_filter_custom_eval_func():
+    calls = []
+    scopes = set()
+    sources = set()
+
+    def eval_func(source, globals_, locals_):
+        calls.append(locals_["__obj"])
+        scopes.add(id(locals_))
+        sources.add(source)
+        return eval(source, globals_, locals_)
+
+    r = JSONPath("$.book[?(@.price<9)].price").parse(data, eval_func=eval_func)
+    assert r == [8.95, 8.99]
+    assert calls == data["book"]
+    assert len(scopes) == 1
+    # evaluators get the rewritten source, which they may rewrite further
+    assert sources == {'__obj["price"]<9'}
+    r = JSONPath("$.book[?(@.price<9)].price").parse(
+        data, eval_func=lambda s, g, l: eval(s.replace("<", ">"), g, l)
+    )
+    assert r == [12.99, 22.99]
+
+
+def test_nested_recursive_descent():
+    obj = {"a": {"a": {"b": 1}, "b": 2}}
+    jp = JSONPath("$..a..b")
+    assert jp.parse(obj) == [2, 1, 1]
+    assert jp.parse(obj, "PATH") == ["$;a;b", "$;a;a;b", "$;a;a;b"]
+
+
+def test_key_chain():
+    data = {"a": [{"b": None}], "c": {"0": 1}}
+    assert JSONPath("$.a[0].b").parse(data) == [None]
+    assert JSONPath("$.a[0].b").parse(data, "PATH") == ["$;a;0;b"]
+    assert JSONPath("$.c.0").parse(data) == [1]
+    assert JSONPath("$.a[1].b").parse(data) == []
+    assert JSONPath("$.a.b").parse(data) == []
+    # followed directly, with no `_trace` and no generated code
+    run = JSONPath("$.a[0].b").programs[True]
+    assert run.__qualname__ == "JSONPath._follow.<locals>.run"
+
+
+def test_filter_expressions():
+    d = {"l": [{"a": {"b": {"c": 1}}, "s": "x@y", "n": [1, 2]}, {"s": "z", "n": []}]}
+    assert JSONPath("$.l[?(@.a.b.c==1)].s").parse(d) == ["x@y"]
+    assert JSONPath("$.l[?(len(@.n)>1)].s").parse(d) == ["x@y"]
+    assert JSONPath("$.l[?(@.a)].s").parse(d) == ["x@y"]
+    assert JSONPath('$.l[?(@.s=="x@y")].n').parse(d) == [[1, 2]]
+    assert JSONPath('$.l[?(@.s.startswith("z"))].s').parse(d) == ["z"]
+    # brackets inside a bracketed filter
+    assert JSONPath("$.l[?(@.n[1] > 1)].s").parse(d) == ["x@y"]
+    assert JSONPath("$.l[?(@.n[0] + @.n[1] == 3)].s").parse(d) == ["x@y"]
+
+
+def test_reentrant_parse():
+    jp = jsonpath.compile("$.book[?(@.price<9)].price")
+    inner = []
+
+    def eval_func(code, globals_, locals_):
+        # parse the same compiled expression while the outer parse is running
+        inner.append(jp.parse(data))
+        return eval(code, globals_, locals_)
+
+    assert jp.parse(data, eval_func=eval_func) == [8.95, 8.99]
+    assert inner == [[8.95, 8.99]] * len(data["book"])
+
+
+def test_threaded_parse():
+    # one shared instance, parsed from several threads from its first parse on
+    jsonpath.cache_clear()
+    jp = jsonpath.compile("$.book[?(@.price<9)].price")
+    values = [8.95, 8.99]
+    paths = ["$;book;0;price", "$;book;2;price"]
+
+    def work(_):
+        return [(jp.parse(data), jp.parse(data, "PATH")) for _ in range(50)]
+
+    with ThreadPoolExecutor(8) as pool:
+        for results in pool.map(work, range(8)):
+            assert results == [(values, paths)] * 50
+
+
+def test_filter_missing_key_quiet(caplog):
+    r = JSONPath('$.book[?(@.isbn=="0-395-19395-8")].title').parse(data)
+    assert r == ["The Lord of the Rings"]
+    assert not [rec for rec in caplog.records if rec.levelno >= logging.WARNING]
+
+
+def test_recursive_descent_scalars():
+    z = {"z": 3}
+    obj = {"a": {"x": 1, "y": [2, z]}, "b": 4}
+    assert JSONPath("$..*").parse(obj) == [obj["a"], 4, 1, [2, z], 2, z, 3]
+    assert JSONPath("$..y[0]").parse(obj, "PATH") == ["$;a;y;0"]
+    with pytest.raises(ExprSyntaxError):
+        JSONPath("$..(z)").parse(obj)
+
+
+def test_trailing_batch_steps():
+    obj = {"l": [1, 2, 3], "m": {"x": 1, "y": 2}, "d": {"0:2": "key", "x,y": 0}}
+    assert JSONPath("$.l[*]").parse(obj) == [1, 2, 3]
+    assert JSONPath("$.m.*").parse(obj) == [1, 2]
+    assert JSONPath("$.l[::2]").parse(obj) == [1, 3]
+    assert JSONPath("$.d[0:2]").parse(obj) == ["key"]
+    assert JSONPath("$.m[0:2]").parse(obj) == []
+    assert JSONPath("$.m[y,z,x]").parse(obj) == [2, 1]
+    assert JSONPath("$.d[x,y]").parse(obj) == [0]
+
+
+def test_dot_before_bracket():
+    # `a.[b]` reads as `a..b`, a recursive descent
+    obj = {"a": [{"b": 1}, [2, 3]]}
+    assert JSONPath("$.a.[0]").segments == ["a", "..", "0"]
+    assert JSONPath("$.a.[0]").parse(obj) == [{"b": 1}, 2]
+    assert JSONPath("$.a[0]").parse(obj) == [{"b": 1}]